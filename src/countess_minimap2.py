@@ -1,10 +1,19 @@
 """ CountESS Minimap2 Plugin"""
 
+import hashlib
 import logging
-import re
+import os
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, suppress
+from functools import lru_cache
+from itertools import chain
+from threading import Lock, local
 from typing import Optional
 
 import mappy  # type: ignore
+import numpy as np
+import pandas as pd
 from countess.core.parameters import (
     BooleanParam,
     ChoiceParam,
@@ -20,9 +29,169 @@ logger = logging.getLogger(__name__)
 
 VERSION = "0.0.14"
 
+# The operations in a CS string.  `cs_to_hgvs` splits them up without using this,
+# but it is kept as a description of the format.
 CS_STRING_RE = r"(=[ACTGTN]+|:[0-9]+|(?:\*[ACGTN][ACGTN])+|\+[ACGTN]+|-[ACGTN]+)"
 MM2_PRESET_CHOICES = ["sr", "map-pb", "map-ont", "asm5", "asm10", "splice"]
 
+# Indexes loaded from files are shared between all the plugins in this process,
+# keyed on (path, preset, mtime, part size), so that several plugins using the
+# same reference only hold one copy of it in memory.  Each entry holds the
+# indexes of all the parts of a reference.  Only the most recently used few
+# references are kept.
+INDEX_CACHE_SIZE = 2
+_index_cache: dict[tuple, list[mappy.Aligner]] = {}
+_index_cache_lock = Lock()
+
+# `Aligner.map()` allocates a fresh mappy.ThreadBuffer for every call unless
+# it is given one, so each thread keeps its own to reuse.
+_thread_buffers = local()
+
+
+def load_index(ref_path: str, preset: str) -> mappy.Aligner:
+    """Loads a minimap2 index for the MMI or FASTA file at `ref_path`.
+
+    Building an index from a FASTA file can take a long time for a large
+    reference, so the index is saved to an MMI file alongside the FASTA file,
+    and that is loaded instead next time around.  The MMI filename includes a
+    hash of the path, preset and modification time of the FASTA file, so a
+    changed reference gets a new index.  If the MMI file can't be written the
+    index is just built in memory."""
+
+    if ref_path.endswith(".mmi"):
+        return mappy.Aligner(ref_path, preset=preset)
+
+    try:
+        mtime = os.path.getmtime(ref_path)
+    except OSError:
+        return mappy.Aligner(ref_path, preset=preset)
+
+    cache_key = hashlib.sha1(f"{ref_path} {preset} {mtime}".encode()).hexdigest()[:16]
+    mmi_path = f"{ref_path}.{preset}.{cache_key}.mmi"
+
+    if os.path.exists(mmi_path):
+        aligner = mappy.Aligner(mmi_path, preset=preset)
+        if aligner:
+            return aligner
+        logger.warning("Can't load cached index %s", mmi_path)
+
+    # the index is written to a temporary file first so that an interrupted
+    # build can't leave a broken MMI file behind.
+    tmp_path = f"{mmi_path}.{os.getpid()}.tmp"
+    aligner = mappy.Aligner(ref_path, preset=preset, fn_idx_out=tmp_path)
+    if not aligner:
+        logger.info("Can't write cached index %s", mmi_path)
+        with suppress(OSError):
+            os.remove(tmp_path)
+        return mappy.Aligner(ref_path, preset=preset)
+
+    # mappy doesn't say if it couldn't write the index, in which case there's
+    # no temporary file to move.
+    try:
+        os.replace(tmp_path, mmi_path)
+    except OSError:
+        logger.info("Can't write cached index %s", mmi_path)
+        with suppress(OSError):
+            os.remove(tmp_path)
+    return aligner
+
+
+def plan_reference_parts(ref_path: str, part_size: int) -> list[int]:
+    """Returns which part each sequence in the FASTA file at `ref_path` goes
+    in, to make parts of at most about `part_size` bases each."""
+    part_numbers = []
+    part_number = 0
+    bases = 0
+    for _, seq, _ in mappy.fastx_read(ref_path):
+        if bases > 0 and bases + len(seq) > part_size:
+            part_number += 1
+            bases = 0
+        part_numbers.append(part_number)
+        bases += len(seq)
+    return part_numbers
+
+
+def write_reference_parts(ref_path: str, part_paths: list[str], part_numbers: list[int]):
+    """Writes each sequence in the FASTA file at `ref_path` to the part at
+    `part_paths[part_numbers[n]]`."""
+
+    # as in `load_index`, the parts are written to temporary files first
+    # so that an interrupted split can't leave a broken part behind.
+    tmp_paths = [f"{path}.{os.getpid()}.tmp" for path in part_paths]
+    with ExitStack() as stack:
+        part_files = [stack.enter_context(open(path, "w", encoding="utf-8")) for path in tmp_paths]
+        for (name, seq, _), n in zip(mappy.fastx_read(ref_path), part_numbers):
+            part_files[n].write(f">{name}\n{seq}\n")
+    for tmp_path, part_path in zip(tmp_paths, part_paths):
+        os.replace(tmp_path, part_path)
+
+
+def split_reference(ref_path: str, part_size: int) -> list[str]:
+    """Splits the FASTA file at `ref_path` into FASTA files of at most about
+    `part_size` bases each, breaking only between sequences, like minimap2's
+    `-I` option.  The parts are written alongside the FASTA file and reused
+    next time around, just like the MMI files from `load_index`.
+    Returns the paths of the parts, or just `ref_path` if it is small enough
+    not to need splitting or if it can't be split."""
+
+    if part_size <= 0 or ref_path.endswith(".mmi"):
+        return [ref_path]
+
+    try:
+        mtime = os.path.getmtime(ref_path)
+        cache_key = hashlib.sha1(f"{ref_path} {part_size} {mtime}".encode()).hexdigest()[:16]
+        list_path = f"{ref_path}.{cache_key}.parts"
+
+        if os.path.exists(list_path):
+            with open(list_path, "r", encoding="utf-8") as fh:
+                part_paths = fh.read().splitlines()
+            if all(os.path.exists(p) for p in part_paths):
+                return part_paths
+
+        # the parts are planned first, so that a reference which doesn't
+        # need splitting doesn't get copied.
+        part_numbers = plan_reference_parts(ref_path, part_size)
+        num_parts = max(part_numbers, default=0) + 1
+        if num_parts == 1:
+            part_paths = [ref_path]
+        else:
+            part_paths = [f"{ref_path}.{cache_key}.{n}.fa" for n in range(num_parts)]
+            write_reference_parts(ref_path, part_paths, part_numbers)
+
+        # the list of parts is written last, so it only exists once they're all there.
+        tmp_path = f"{list_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fh:
+            fh.write("".join(p + "\n" for p in part_paths))
+        os.replace(tmp_path, list_path)
+        return part_paths
+
+    except OSError as exc:
+        logger.warning("Can't split reference %s", ref_path, exc_info=exc)
+        return [ref_path]
+
+
+def get_shared_indexes(ref_path: str, preset: str, part_size: int = 0) -> list[mappy.Aligner]:
+    """Like `load_index` but returns the index of each part of the reference, see
+    `split_reference`, and returns the same Aligners to every caller asking for
+    the same, unchanged, reference."""
+    try:
+        mtime: Optional[float] = os.path.getmtime(ref_path)
+    except OSError:
+        mtime = None
+    key = (os.path.abspath(ref_path), preset, mtime, part_size)
+
+    # holding the lock while splitting and loading means that plugins which
+    # start at the same time don't all build the same index at once.
+    with _index_cache_lock:
+        aligners = _index_cache.pop(key, None)
+        if aligners is None:
+            aligners = [load_index(path, preset) for path in split_reference(ref_path, part_size)]
+        if all(aligners):
+            _index_cache[key] = aligners
+            while len(_index_cache) > INDEX_CACHE_SIZE:
+                del _index_cache[next(iter(_index_cache))]
+    return aligners
+
 
 def cs_to_hgvs(cs_string: str, ctg: str = "", offset: int = 1) -> str:
     """Turn the Minimap2 "difference string" into a HGVS string
@@ -70,6 +239,9 @@ def cs_to_hgvs(cs_string: str, ctg: str = "", offset: int = 1) -> str:
 
     >>> cs_to_hgvs(":10-a:10*at")
     'g.[11del;22A>T]'
+
+    >>> cs_to_hgvs("=ACGT*ag=TT")
+    'g.5A>G'
     """
 
     # XXX doesn't support '~'.
@@ -82,13 +254,29 @@ def cs_to_hgvs(cs_string: str, ctg: str = "", offset: int = 1) -> str:
     if ctg and ctg != "N/A":
         prefix = ctg + ":" + prefix
 
-    for op in re.findall(CS_STRING_RE, cs_string.upper()):
-        if op[0] == ":":
-            offset += int(op[1:])
+    # Rather than matching CS_STRING_RE, put a space in front of each operation
+    # character and let `str.split()` break the string up into operations.
+    # ":" is just replaced by the space, so that the commonest operation,
+    # ":N", comes out as a bare number which `int()` can take directly.
+    cs = cs_string.upper().replace(":", " ")
+    for c in "=*+-~":
+        cs = cs.replace(c, " " + c)
+    ops = cs.split()
+
+    num_ops = len(ops)
+    i = 0
+    while i < num_ops:
+        op = ops[i]
+        i += 1
+        if op[0].isdigit():
+            offset += int(op)
         elif op[0] == "=":
             offset += len(op) - 1
         elif op[0] == "*":
-            # regex can match multiple operations like "*AT*AT*GC"
+            # combine consecutive substitutions like "*AT*AT*GC"
+            while i < num_ops and ops[i][0] == "*":
+                op += ops[i]
+                i += 1
             if len(op) > 3:
                 hgvs_ops.append(f"{offset}_{offset+len(op)//3-1}delins{op[2::3]}")
             else:
@@ -107,7 +295,244 @@ def cs_to_hgvs(cs_string: str, ctg: str = "", offset: int = 1) -> str:
     elif len(hgvs_ops) == 1:
         return prefix + hgvs_ops[0]
     else:
-        return prefix + "[" + ";".join(hgvs_ops) + "]"
+        return f"{prefix}[{';'.join(hgvs_ops)}]"
+
+
+def compile_hgvs_kernel() -> Callable:  # pylint: disable=too-many-locals,too-many-statements
+    """Compiles, with Numba, a kernel which does the same job as `cs_to_hgvs`
+    on a whole batch of CS strings at once.  The CS strings are passed in
+    concatenated together as uppercase ASCII in a uint8 array, and the HGVS
+    strings, less their "g." prefixes, come back the same way."""
+
+    # pylint: disable=import-outside-toplevel
+    from numba import njit  # type: ignore
+
+    EQUALS, COLON, STAR, PLUS, MINUS, TILDE = b"=:*+-~"
+    SEMICOLON, UNDERSCORE, GREATER, OPEN, CLOSE = b";_>[]"
+    DEL = np.frombuffer(b"del", dtype=np.uint8)
+    INS = np.frombuffer(b"ins", dtype=np.uint8)
+    DELINS = np.frombuffer(b"delins", dtype=np.uint8)
+
+    @njit(cache=True, nogil=True)
+    def write_int(out, pos, value):
+        start = pos
+        while True:
+            out[pos] = 48 + value % 10
+            value //= 10
+            pos += 1
+            if value == 0:
+                break
+        # the digits come out least significant first, so reverse them.
+        end = pos - 1
+        while start < end:
+            out[start], out[end] = out[end], out[start]
+            start += 1
+            end -= 1
+        return pos
+
+    @njit(cache=True, nogil=True)
+    def write_text(out, pos, text):
+        for c in text:
+            out[pos] = c
+            pos += 1
+        return pos
+
+    @njit(cache=True, nogil=True)
+    def is_op(c):
+        return c in (EQUALS, COLON, STAR, PLUS, MINUS, TILDE)
+
+    @njit(cache=True, nogil=True)
+    def reserve(out, pos, size):
+        # returns `out`, or a bigger copy of it if there's not room for
+        # `size` more bytes after `pos`.
+        if pos + size <= len(out):
+            return out
+        bigger = np.empty(max(2 * len(out), pos + size), dtype=np.uint8)
+        bigger[:pos] = out[:pos]
+        return bigger
+
+    @njit(cache=True, nogil=True)
+    def kernel(cs_buf, cs_starts, offsets):  # pylint: disable=too-many-locals,too-many-statements
+        num_rows = len(offsets)
+
+        # the output is usually about the same size as the input, but can be
+        # much bigger, so the buffer grows as needed.  Each operation writes
+        # at most two 20 digit numbers, 8 more bytes and its own bases, and
+        # each row needs up to two bytes for "[" and "]" or "=".
+        out = np.empty(len(cs_buf) + 2 * num_rows + 64, dtype=np.uint8)
+        out_starts = np.empty(num_rows, dtype=np.int64)
+        out_ends = np.empty(num_rows, dtype=np.int64)
+
+        pos = 0
+        for row in range(num_rows):
+            offset = offsets[row]
+            end = cs_starts[row + 1]
+            row_start = pos
+            out = reserve(out, pos, 2)
+            # leave room for a "[", in case there's more than one operation.
+            out[pos] = OPEN
+            pos += 1
+            num_ops = 0
+
+            i = cs_starts[row]
+            while i < end:
+                c = cs_buf[i]
+                j = i + 1
+                while j < end and not is_op(cs_buf[j]):
+                    j += 1
+
+                if c == COLON:
+                    value = 0
+                    for k in range(i + 1, j):
+                        value = value * 10 + cs_buf[k] - 48
+                    offset += value
+                elif c == EQUALS:
+                    offset += j - i - 1
+                elif c == STAR:
+                    # combine consecutive substitutions like "*AT*AT*GC"
+                    while j < end and cs_buf[j] == STAR:
+                        j += 1
+                        while j < end and not is_op(cs_buf[j]):
+                            j += 1
+                    length = (j - i) // 3
+                    out = reserve(out, pos, j - i + 48)
+                    if num_ops:
+                        out[pos] = SEMICOLON
+                        pos += 1
+                    num_ops += 1
+                    pos = write_int(out, pos, offset)
+                    if length > 1:
+                        out[pos] = UNDERSCORE
+                        pos = write_int(out, pos + 1, offset + length - 1)
+                        pos = write_text(out, pos, DELINS)
+                        for k in range(i + 2, j, 3):
+                            out[pos] = cs_buf[k]
+                            pos += 1
+                    else:
+                        out[pos] = cs_buf[i + 1]
+                        out[pos + 1] = GREATER
+                        out[pos + 2] = cs_buf[i + 2]
+                        pos += 3
+                    offset += length
+                elif c == PLUS:
+                    out = reserve(out, pos, j - i + 48)
+                    if num_ops:
+                        out[pos] = SEMICOLON
+                        pos += 1
+                    num_ops += 1
+                    pos = write_int(out, pos, offset - 1)
+                    out[pos] = UNDERSCORE
+                    pos = write_int(out, pos + 1, offset)
+                    pos = write_text(out, pos, INS)
+                    pos = write_text(out, pos, cs_buf[i + 1 : j])
+                elif c == MINUS:
+                    length = j - i - 1
+                    out = reserve(out, pos, 48)
+                    if num_ops:
+                        out[pos] = SEMICOLON
+                        pos += 1
+                    num_ops += 1
+                    pos = write_int(out, pos, offset)
+                    if length > 1:
+                        out[pos] = UNDERSCORE
+                        pos = write_int(out, pos + 1, offset + length - 1)
+                    pos = write_text(out, pos, DEL)
+                    offset += length
+                i = j
+
+            out = reserve(out, pos, 1)
+            if num_ops == 0:
+                out[pos] = EQUALS
+                pos += 1
+                out_starts[row] = row_start + 1
+            elif num_ops == 1:
+                out_starts[row] = row_start + 1
+            else:
+                out[pos] = CLOSE
+                pos += 1
+                out_starts[row] = row_start
+            out_ends[row] = pos
+
+        return out[:pos], out_starts, out_ends
+
+    # Numba doesn't compile anything until the first call, so make that call
+    # here, where a failure can still be caught, rather than on real data.
+    # This also loads the compiled code from Numba's cache, if it's there.
+    kernel(np.frombuffer(b":1*AT", dtype=np.uint8), np.array([0, 5], dtype=np.int64), np.ones(1, dtype=np.int64))
+
+    return kernel
+
+
+# Loading the kernel takes a second or two, mostly importing Numba, which is
+# more than `cs_to_hgvs` takes for this many rows, so smaller batches don't
+# bother with the kernel unless it is already loaded.
+HGVS_KERNEL_MIN_ROWS = 50000
+
+_hgvs_kernel: Optional[Callable] = None
+_hgvs_kernel_lock = Lock()
+_hgvs_kernel_tried = False
+
+
+def get_hgvs_kernel() -> Optional[Callable]:
+    """Returns the compiled batch HGVS kernel, or None if Numba isn't available
+    or the kernel can't be compiled."""
+    global _hgvs_kernel, _hgvs_kernel_tried  # pylint: disable=global-statement
+    with _hgvs_kernel_lock:
+        if not _hgvs_kernel_tried:
+            _hgvs_kernel_tried = True
+            try:
+                _hgvs_kernel = compile_hgvs_kernel()
+            except ImportError:
+                pass
+            except Exception as exc:  # pylint: disable=broad-exception-caught
+                logger.warning("Can't compile HGVS kernel", exc_info=exc)
+    return _hgvs_kernel
+
+
+def _reset_locks_after_fork():
+    """The CountESS GUI forks to run a pipeline, possibly while another thread
+    is building an index or compiling the kernel and holding its lock.  That
+    thread doesn't exist in the child, so the child needs fresh locks."""
+    global _index_cache_lock, _hgvs_kernel_lock, _hgvs_kernel_tried  # pylint: disable=global-statement
+    _index_cache_lock = Lock()
+    _hgvs_kernel_lock = Lock()
+    # a kernel which was still being compiled never turns up in the child,
+    # so let the child have another go at it.
+    if _hgvs_kernel is None:
+        _hgvs_kernel_tried = False
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_locks_after_fork)
+
+
+def cs_to_hgvs_batch(cs_strings, ctgs, offsets) -> list[str]:
+    """Like `cs_to_hgvs` but for a batch of CS strings, with the matching
+    contig names and offsets.  If Numba is installed, this is much faster
+    than calling `cs_to_hgvs` on each CS string in turn, at least for big
+    batches, see `HGVS_KERNEL_MIN_ROWS`.
+
+    >>> cs_to_hgvs_batch([":10*at:10", ":10", ":10-a:10*at"], ["", "chr1", "N/A"], [1, 1, 1])
+    ['g.11A>T', 'chr1:g.=', 'g.[11del;22A>T]']
+    """
+    kernel = _hgvs_kernel
+    if kernel is None and len(cs_strings) >= HGVS_KERNEL_MIN_ROWS:
+        kernel = get_hgvs_kernel()
+    if kernel is None:
+        return [cs_to_hgvs(cs, ctg, offset) for cs, ctg, offset in zip(cs_strings, ctgs, offsets)]
+
+    encoded = [cs.upper().encode("ascii") for cs in cs_strings]
+    cs_starts = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=cs_starts[1:])
+    cs_buf = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+    out, out_starts, out_ends = kernel(cs_buf, cs_starts, np.asarray(offsets, dtype=np.int64))
+    text = out.tobytes().decode("ascii")
+
+    return [
+        (ctg + ":g." if ctg and ctg != "N/A" else "g.") + text[start:end]
+        for ctg, start, end in zip(ctgs, out_starts.tolist(), out_ends.tolist())
+    ]
 
 
 class MiniMap2Plugin(PandasTransformSingleToDictPlugin):
@@ -125,6 +550,13 @@ class MiniMap2Plugin(PandasTransformSingleToDictPlugin):
     FILE_TYPES = [("MMI", "*.mmi"), ("FASTA", "*.fa *.fasta *.fa.gz *.fasta.gz")]
     CHARACTER_SET = set(["A", "C", "G", "T"])
 
+    # sequences are handed to the thread pool in batches of this many, to keep
+    # the per-task overhead small compared to the time spent in mappy.
+    ALIGN_BATCH_SIZE = 256
+
+    # number of distinct sequences `process_value` remembers alignments for.
+    ALIGN_CACHE_SIZE = 100000
+
     column = ColumnChoiceParam("Input Column", "sequence")
     prefix = StringParam("Output Column Prefix", "mm")
     ref = FileParam("Ref FA / Ref MMI", file_types=FILE_TYPES)
@@ -136,54 +568,231 @@ class MiniMap2Plugin(PandasTransformSingleToDictPlugin):
     cigar = BooleanParam("Output Cigar String", False)
     cs = BooleanParam("Output CS String", False)
     hgvs = BooleanParam("Output HGVS", False)
-
-    # XXX a shared-memory cache would make a lot of sense
-    # here ...
-    aligner = None
+    index_size = IntegerParam("Split Index Size (Gbases)", 0)
+
+    # there's more than one aligner if the reference index is split into
+    # parts, see `split_reference`.  Indexes loaded from files are shared,
+    # see `get_shared_indexes`.
+    aligners: list[mappy.Aligner] = []
+
+    # reads are often repeated, so `process_value` caches alignments.
+    # This is rebuilt by `prepare()` as the aligner may have changed.
+    align_cached: Optional[Callable] = None
+
+    # parameter values which are needed for every row are looked up
+    # once, by `prepare()`, rather than for each row.
+    # `output_keys` maps each of the outputs which are turned on to its
+    # output column name.
+    min_match_length = 0
+    calculate_cs = False
+    drop_unmatched = False
+    output_keys: dict[str, str] = {}
 
     def prepare(self, sources: list[str], row_limit: Optional[int] = None):
         if self.seq:
-            self.aligner = mappy.Aligner(seq=self.seq.value, preset=self.preset.value)
+            aligners = [mappy.Aligner(seq=self.seq.value, preset=self.preset.value)]
         elif self.ref:
-            self.aligner = mappy.Aligner(self.ref.value, preset=self.preset.value)
-            # TODO check file load successful: self.aligner.seq_names is not None?
+            aligners = get_shared_indexes(self.ref.value, self.preset.value, self.index_size.value * 10**9)
+            # TODO check file load successful: aligner.seq_names is not None?
         else:
-            self.aligner = None
+            aligners = []
+        self.aligners = aligners if all(aligners) else []
+
+        self.min_match_length = abs(self.min_length.value)
+        self.calculate_cs = bool(self.cs or self.hgvs)
+        self.drop_unmatched = bool(self.drop)
+        outputs = (
+            (self.location, ("ctg", "r_st", "r_en", "strand")),
+            (self.cigar, ("cigar",)),
+            (self.cs, ("cs",)),
+            (self.hgvs, ("hgvs",)),
+        )
+        self.output_keys = {key: self.prefix + "_" + key for param, keys in outputs if param for key in keys}
+
+        self.align_cached = lru_cache(maxsize=self.ALIGN_CACHE_SIZE)(self.align)
 
     def output_dict(self, alignment):
+        keys = self.output_keys
         d = {}
-        if self.location:
+        if "ctg" in keys:
             d.update(
                 {
-                    self.prefix + "_ctg": alignment.ctg if alignment else None,
-                    self.prefix + "_r_st": alignment.r_st if alignment else None,
-                    self.prefix + "_r_en": alignment.r_en if alignment else None,
-                    self.prefix + "_strand": alignment.strand if alignment else None,
+                    keys["ctg"]: alignment.ctg if alignment else None,
+                    keys["r_st"]: alignment.r_st if alignment else None,
+                    keys["r_en"]: alignment.r_en if alignment else None,
+                    keys["strand"]: alignment.strand if alignment else None,
                 }
             )
-        if self.cigar:
-            d[self.prefix + "_cigar"] = alignment.cigar_str if alignment else None
-        if self.cs:
-            d[self.prefix + "_cs"] = alignment.cs if alignment else None
-        if self.hgvs:
-            d[self.prefix + "_hgvs"] = (
-                cs_to_hgvs(alignment.cs, alignment.ctg, alignment.r_st + 1) if alignment else None
-            )
+        if "cigar" in keys:
+            d[keys["cigar"]] = alignment.cigar_str if alignment else None
+        if "cs" in keys:
+            d[keys["cs"]] = alignment.cs if alignment else None
+        if "hgvs" in keys:
+            d[keys["hgvs"]] = cs_to_hgvs(alignment.cs, alignment.ctg, alignment.r_st + 1) if alignment else None
         return d
 
+    def align(self, value: str):
+        """Returns the first alignment of `value` which is at least `min_length` long,
+        or None if there isn't one.  If the index is split into parts, this is
+        the one from whichever part has the most matching bases."""
+        min_length = self.min_match_length
+
+        buf = getattr(_thread_buffers, "buf", None)
+        if buf is None:
+            buf = _thread_buffers.buf = mappy.ThreadBuffer()
+
+        best = None
+        for aligner in self.aligners:
+            # XXX only returns first match
+            for z in aligner.map(value, buf=buf, cs=self.calculate_cs):
+                if z.r_en - z.r_st >= min_length:
+                    if best is None or z.mlen > best.mlen:
+                        best = z
+                    break
+        return best
+
+    def align_batch(self, values) -> list:
+        return [self.align(value) for value in values]
+
     def process_value(self, value: str):
-        if not self.aligner:
+        if not self.aligners:
+            return None
+        assert self.align_cached is not None
+
+        alignment = self.align_cached(value)
+        if alignment is None and self.drop_unmatched:
+            return None
+        else:
+            return self.output_dict(alignment)
+
+    def get_sequences(self, dataframe: pd.DataFrame) -> Optional[np.ndarray]:
+        column_name = self.column.value
+        if column_name in dataframe:
+            return dataframe[column_name].to_numpy(copy=False)
+        elif column_name in dataframe.index.names:
+            return dataframe.index.get_level_values(column_name).to_numpy()
+        else:
             return None
 
-        min_length = abs(self.min_length.value)
+    def align_uniques(self, uniques: np.ndarray) -> list:
+        """Aligns each of `uniques`, in batches on a pool of threads, and returns
+        the alignments in the same order as `uniques`."""
+
+        # the longest sequences are aligned first, so that the batches get
+        # shorter as the pool works through them and one long batch doesn't
+        # hold up the end.  `order[rank]` is where each result goes.
+        order = np.argsort([-len(u) for u in uniques], kind="stable")
+        sorted_uniques = uniques[order]
+        batches = [
+            sorted_uniques[start : start + self.ALIGN_BATCH_SIZE]
+            for start in range(0, len(uniques), self.ALIGN_BATCH_SIZE)
+        ]
+
+        # mappy releases the GIL while it is aligning, so threads can usefully
+        # align several batches at once.  The pool only lasts for this call:
+        # a pool kept between runs would be useless after the CountESS GUI
+        # forks to run the pipeline, as its threads don't exist in the child.
+        alignments: list = [None] * len(uniques)
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            for i, z in zip(order.tolist(), chain.from_iterable(executor.map(self.align_batch, batches))):
+                alignments[i] = z
+        return alignments
+
+    def tabulate_alignments(self, alignments: list) -> dict[str, np.ndarray]:
+        """Unpacks `alignments` into an array per field.  Each array has an extra,
+        always unmatched, entry on the end, for rows with no sequence."""
+        n = len(alignments) + 1
+        matched = np.zeros(n, dtype=bool)
+        ctg = np.empty(n, dtype=object)
+        r_st = np.zeros(n, dtype=np.int64)
+        r_en = np.zeros(n, dtype=np.int64)
+        strand = np.zeros(n, dtype=np.int8)
+        cigar = np.empty(n, dtype=object)
+        cs = np.empty(n, dtype=object)
+
+        output_cigar = "cigar" in self.output_keys
+        calculate_cs = self.calculate_cs
+
+        for i, z in enumerate(alignments):
+            if z is None:
+                continue
+            matched[i] = True
+            ctg[i] = z.ctg
+            r_st[i] = z.r_st
+            r_en[i] = z.r_en
+            strand[i] = z.strand
+            if output_cigar:
+                cigar[i] = z.cigar_str
+            if calculate_cs:
+                cs[i] = z.cs
+
+        return {"matched": matched, "ctg": ctg, "r_st": r_st, "r_en": r_en, "strand": strand, "cigar": cigar, "cs": cs}
+
+    def build_columns(self, results: dict[str, np.ndarray], codes: np.ndarray) -> dict:
+        """Expands the per-sequence `results` back out to one per row, using
+        `codes` to pick out each row's sequence, and returns the output columns."""
+        keys = self.output_keys
+        columns = {}
+        if "ctg" in keys:
+            # the numeric columns are nullable integers, rather than
+            # floats, with unmatched rows masked out.
+            unmatched = ~results["matched"][codes]
+            columns[keys["ctg"]] = results["ctg"][codes]
+            columns[keys["r_st"]] = pd.arrays.IntegerArray(results["r_st"][codes], unmatched.copy())
+            columns[keys["r_en"]] = pd.arrays.IntegerArray(results["r_en"][codes], unmatched.copy())
+            columns[keys["strand"]] = pd.arrays.IntegerArray(results["strand"][codes], unmatched)
+        if "cigar" in keys:
+            columns[keys["cigar"]] = results["cigar"][codes]
+        if "cs" in keys:
+            columns[keys["cs"]] = results["cs"][codes]
+        if "hgvs" in keys:
+            # HGVS strings are worked out all at once, which is faster if
+            # there's a compiled kernel available, see `cs_to_hgvs_batch`.
+            matched_idx = np.flatnonzero(results["matched"])
+            hgvs = np.empty(len(results["matched"]), dtype=object)
+            hgvs[matched_idx] = cs_to_hgvs_batch(
+                results["cs"][matched_idx], results["ctg"][matched_idx], results["r_st"][matched_idx] + 1
+            )
+            columns[keys["hgvs"]] = hgvs[codes]
+        return columns
+
+    def process_dataframe(self, dataframe: pd.DataFrame) -> Optional[pd.DataFrame]:
+        """Aligns the whole input column in one pass, rather than going through
+        `process_value` for each row, and builds the output columns as arrays
+        which get added to the dataframe in bulk.  Each distinct sequence is
+        only aligned once."""
+        if not self.aligners:
+            return None
+
+        try:
+            seqs = self.get_sequences(dataframe)
+            if seqs is None:
+                return None
+
+            # `codes` maps each row to its entry in `uniques`.  Null sequences get
+            # a code of -1, which picks out the extra, always unmatched, slot at
+            # the end of each of the result arrays.
+            codes, uniques = pd.factorize(seqs)
+            results = self.tabulate_alignments(self.align_uniques(uniques))
+
+            if self.drop_unmatched:
+                # unmatched rows are dropped before the output columns are
+                # built, so they are only ever built at their final length.
+                rows = np.flatnonzero(results["matched"][codes])
+                dataframe = dataframe.take(rows)
+                codes = codes[rows]
+            else:
+                # don't modify the input dataframe, it may be shared with other
+                # plugins.  A shallow copy is enough for that: setting columns
+                # replaces them in the copy rather than writing into the
+                # original's arrays, and the input data isn't duplicated.
+                dataframe = dataframe.copy(deep=False)
 
-        # XXX only returns first match
-        x = self.aligner.map(value, cs=self.cs or self.hgvs)
-        for z in x:
-            if z.r_en - z.r_st >= min_length:
-                return self.output_dict(z)
+            for column_name, values in self.build_columns(results, codes).items():
+                dataframe[column_name] = values
 
-        if self.drop:
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            logger.warning("Exception", exc_info=exc)
             return None
-        else:
-            return self.output_dict(None)
+
+        return dataframe
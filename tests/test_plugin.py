@@ -0,0 +1,292 @@
+import multiprocessing
+import os
+import random
+
+import pandas as pd
+import pytest
+
+import countess_minimap2
+from countess_minimap2 import (
+    MiniMap2Plugin,
+    cs_to_hgvs,
+    cs_to_hgvs_batch,
+    get_hgvs_kernel,
+    get_shared_indexes,
+    load_index,
+    split_reference,
+)
+
+rng = random.Random(2)
+
+
+def random_seq(length: int) -> str:
+    return "".join(rng.choice("ACGT") for _ in range(length))
+
+
+REF_SEQS = {f"chr{n}": random_seq(1000) for n in (1, 2)}
+
+
+def mutate(seq: str) -> str:
+    seq_list = list(seq)
+    for _ in range(rng.randint(0, 3)):
+        seq_list[rng.randrange(len(seq_list))] = rng.choice("ACGT")
+    return "".join(seq_list)
+
+
+def random_read() -> str:
+    if rng.random() < 0.2:
+        # won't match anything
+        return random_seq(60)
+    ref_seq = rng.choice(list(REF_SEQS.values()))
+    start = rng.randrange(800)
+    return mutate(ref_seq[start : start + rng.randint(40, 150)])
+
+
+READS = [random_read() for _ in range(100)]
+
+
+@pytest.fixture(name="ref_path")
+def fixture_ref_path(tmp_path):
+    path = tmp_path / "ref.fa"
+    path.write_text("".join(f">{name}\n{seq}\n" for name, seq in REF_SEQS.items()))
+    return str(path)
+
+
+def make_plugin(ref_path, **params):
+    plugin = MiniMap2Plugin()
+    plugin.set_parameter("ref", ref_path)
+    for key, value in {"cigar": True, "cs": True, "hgvs": True, **params}.items():
+        plugin.set_parameter(key, value)
+    plugin.prepare(["test"])
+    return plugin
+
+
+def expected_dataframe(plugin, dataframe, seqs, drop=False):
+    """What you'd get by calling `process_value` on each row."""
+    rows = []
+    positions = []
+    for position, seq in enumerate(seqs):
+        if seq is None:
+            d = None if drop else plugin.output_dict(None)
+        else:
+            d = plugin.process_value(seq)
+        if d is not None:
+            rows.append(d)
+            positions.append(position)
+    expected = dataframe.iloc[positions]
+    return expected.assign(**{key: [d[key] for d in rows] for key in rows[0]})
+
+
+def as_list(series):
+    return series.astype(object).where(series.notna(), None).tolist()
+
+
+def assert_same(expected, got):
+    assert list(got.index) == list(expected.index)
+    assert list(got.columns) == list(expected.columns)
+    for column_name in expected.columns:
+        assert as_list(got[column_name]) == as_list(expected[column_name]), column_name
+
+
+@pytest.mark.parametrize("drop", [False, True])
+def test_process_dataframe(ref_path, drop):
+    seqs = READS + [None] + READS[:10]
+    dataframe = pd.DataFrame({"sequence": seqs, "thing": range(len(seqs))})
+    plugin = make_plugin(ref_path, drop=drop)
+
+    got = plugin.process_dataframe(dataframe)
+    assert_same(expected_dataframe(plugin, dataframe, seqs, drop), got)
+    assert "mm_ctg" not in dataframe
+
+    if drop:
+        assert len(got) < len(dataframe)
+    else:
+        assert got["mm_ctg"].isna().sum() > 1
+
+
+def test_process_dataframe_duplicate_index(ref_path):
+    seqs = READS[:20]
+    dataframe = pd.DataFrame({"sequence": seqs}, index=[n // 2 for n in range(len(seqs))])
+    plugin = make_plugin(ref_path, drop=True)
+
+    assert_same(expected_dataframe(plugin, dataframe, seqs, True), plugin.process_dataframe(dataframe))
+
+
+def test_process_dataframe_index_column(ref_path):
+    dataframe = pd.DataFrame({"sequence": READS[:20], "thing": range(20)}).set_index("sequence")
+    plugin = make_plugin(ref_path)
+
+    got = plugin.process_dataframe(dataframe)
+    assert_same(expected_dataframe(plugin, dataframe, READS[:20]), got)
+    assert got["mm_ctg"].notna().any()
+
+
+def run_in_fork(target, timeout=30):
+    """Runs `target` in a forked child process, like the CountESS GUI does
+    when it runs a pipeline, and checks it finishes successfully."""
+    if "fork" not in multiprocessing.get_all_start_methods():
+        pytest.skip("can't fork")
+    process = multiprocessing.get_context("fork").Process(target=target)
+    process.start()
+    process.join(timeout)
+    if process.is_alive():
+        process.kill()
+        pytest.fail("child process hung")
+    assert process.exitcode == 0
+
+
+def test_process_dataframe_after_fork(ref_path):
+    dataframe = pd.DataFrame({"sequence": READS})
+    plugin = make_plugin(ref_path)
+    expected = plugin.process_dataframe(dataframe)
+
+    def child():
+        plugin.prepare(["test"])
+        assert_same(expected, plugin.process_dataframe(dataframe))
+
+    run_in_fork(child)
+
+
+def test_locks_after_fork(ref_path):
+    # as if another thread was part way through building an index or
+    # compiling the HGVS kernel when the process forked.
+    with countess_minimap2._index_cache_lock, countess_minimap2._hgvs_kernel_lock:  # pylint: disable=protected-access
+
+        def child():
+            plugin = make_plugin(ref_path)
+            assert plugin.aligners
+            assert plugin.process_dataframe(pd.DataFrame({"sequence": READS})) is not None
+            get_hgvs_kernel()
+
+        run_in_fork(child)
+
+
+def random_cs() -> str:
+    ops = [
+        lambda: f":{rng.randint(1, 10 ** rng.randint(1, 12))}",
+        lambda: "=" + "".join(rng.choice("acgt") for _ in range(rng.randint(1, 5))),
+        lambda: f"*{rng.choice('acgt')}{rng.choice('acgt')}",
+        lambda: "+" + "".join(rng.choice("acgt") for _ in range(rng.randint(1, 5))),
+        lambda: "-" + "".join(rng.choice("acgt") for _ in range(rng.randint(1, 5))),
+    ]
+    return "".join(rng.choice(ops)() for _ in range(rng.randint(0, 8)))
+
+
+def test_hgvs_kernel():
+    pytest.importorskip("numba")
+    assert get_hgvs_kernel() is not None
+
+    # big offsets make the output much longer than the input, which the
+    # kernel has to make room for.
+    cs_strings = [random_cs() for _ in range(1000)] + ["*at" * 100]
+    ctgs = [rng.choice(["", "chr1", "N/A"]) for _ in cs_strings]
+    offsets = [rng.randint(1, 10**15) for _ in cs_strings]
+
+    expected = [cs_to_hgvs(cs, ctg, offset) for cs, ctg, offset in zip(cs_strings, ctgs, offsets)]
+    assert cs_to_hgvs_batch(cs_strings, ctgs, offsets) == expected
+
+
+def aligner_calls(monkeypatch) -> list:
+    """Records the arguments of each Aligner made from here on."""
+    calls = []
+    real_aligner = countess_minimap2.mappy.Aligner
+
+    def aligner(*args, **kwargs):
+        calls.append((args, kwargs))
+        return real_aligner(*args, **kwargs)
+
+    monkeypatch.setattr(countess_minimap2.mappy, "Aligner", aligner)
+    return calls
+
+
+def test_load_index(ref_path, monkeypatch):
+    index_dir = os.path.dirname(ref_path)
+    assert load_index(ref_path, "sr").seq_names == list(REF_SEQS)
+    mmi_files = [f for f in os.listdir(index_dir) if f.endswith(".mmi")]
+    assert len(mmi_files) == 1
+    assert not [f for f in os.listdir(index_dir) if f.endswith(".tmp")]
+
+    # next time around, the saved index is loaded instead.
+    calls = aligner_calls(monkeypatch)
+    assert load_index(ref_path, "sr").seq_names == list(REF_SEQS)
+    assert calls == [((os.path.join(index_dir, mmi_files[0]),), {"preset": "sr"})]
+
+    # but if the reference changes, the index is built again.
+    mtime = os.path.getmtime(ref_path) + 10
+    os.utime(ref_path, (mtime, mtime))
+    calls.clear()
+    assert load_index(ref_path, "sr").seq_names == list(REF_SEQS)
+    assert calls[0][0] == (ref_path,)
+    assert len([f for f in os.listdir(index_dir) if f.endswith(".mmi")]) == 2
+
+    # different presets get different indexes
+    load_index(ref_path, "map-ont")
+    assert len([f for f in os.listdir(index_dir) if f.endswith(".mmi")]) == 3
+
+
+def test_load_index_unwritable(ref_path, monkeypatch):
+    index_dir = os.path.dirname(ref_path)
+
+    def replace(*_):
+        raise PermissionError("nope")
+
+    monkeypatch.setattr(os, "replace", replace)
+    aligner = load_index(ref_path, "sr")
+    assert list(aligner.map(READS[1]))
+    assert sorted(os.listdir(index_dir)) == ["ref.fa"]
+
+
+def test_load_index_write_fails(ref_path, monkeypatch):
+    real_aligner = countess_minimap2.mappy.Aligner
+
+    def aligner(*args, fn_idx_out=None, **kwargs):
+        if fn_idx_out is None:
+            return real_aligner(*args, **kwargs)
+        # leave half an index behind, and return an Aligner with no index,
+        # as mappy does if building the index fails.
+        with open(fn_idx_out, "wb") as fh:
+            fh.write(b"MMI")
+        return real_aligner(fn_idx_out + ".missing")
+
+    monkeypatch.setattr(countess_minimap2.mappy, "Aligner", aligner)
+    assert load_index(ref_path, "sr").seq_names == list(REF_SEQS)
+    assert sorted(os.listdir(os.path.dirname(ref_path))) == ["ref.fa"]
+
+
+def test_split_reference(tmp_path):
+    read = random_seq(150)
+    # the first part only matches some of the read, the second all of it, so
+    # the second part's match is the one to keep.
+    ref_seqs = {
+        "partial": random_seq(500) + read[:80] + random_seq(500),
+        "full": random_seq(500) + read + random_seq(500),
+    }
+    ref_path = tmp_path / "ref.fa"
+    ref_path.write_text("".join(f">{name}\n{seq}\n" for name, seq in ref_seqs.items()))
+
+    part_paths = split_reference(str(ref_path), 1200)
+    assert len(part_paths) == 2
+    assert split_reference(str(ref_path), 1200) == part_paths
+    assert split_reference(str(ref_path), 10000) == [str(ref_path)]
+
+    aligners = get_shared_indexes(str(ref_path), "sr", 1200)
+    assert [a.seq_names for a in aligners] == [["partial"], ["full"]]
+    assert get_shared_indexes(str(ref_path), "sr", 1200) is aligners
+    assert list(aligners[0].map(read))
+
+    plugin = make_plugin(str(ref_path))
+    plugin.aligners = aligners
+    assert plugin.align(read).ctg == "full"
+
+
+def test_split_reference_fails(tmp_path, monkeypatch):
+    assert split_reference(str(tmp_path / "missing.fa"), 1000) == [str(tmp_path / "missing.fa")]
+
+    ref_path = tmp_path / "ref.fa"
+    ref_path.write_text("".join(f">{name}\n{seq}\n" for name, seq in REF_SEQS.items()))
+
+    def replace(*_):
+        raise PermissionError("nope")
+
+    monkeypatch.setattr(os, "replace", replace)
+    assert split_reference(str(ref_path), 1000) == [str(ref_path)]